@@ -4,16 +4,237 @@ Gemma 3 270M Local File Assistant
 A simple tool-calling agent that can read and write text files locally.
 """
 
+import asyncio
+import codecs
+import fnmatch
+import functools
 import json
+import mmap
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, Iterator
+
+# Sampling options for the initial, tool-selecting request (low temperature
+# keeps the TOOL/ARGS format reliable) and for the follow-up answer
+QUERY_OPTIONS = {
+    "temperature": 0.1,
+    "top_k": 10,
+    "top_p": 0.8,
+    "num_predict": 512
+}
+FOLLOWUP_OPTIONS = {
+    "temperature": 0.3,
+    "num_predict": 256
+}
+
+# Maximum number of search matches reported back to the model
+MAX_SEARCH_RESULTS = 20
+
+# Seconds to wait for ripgrep before giving up on a search
+RG_TIMEOUT = 30
+
+# Bytes inspected at the start of a file to decide whether it is binary
+BINARY_PEEK_SIZE = 4096
+
+# Read size used when counting lines in file_info
+LINE_COUNT_CHUNK_SIZE = 1 << 20
+
+# Maximum number of characters read_file returns to the model
+READ_FILE_MAX_CHARS = 2000
+
+# Number of files whose read_file prefix and line count are kept in memory
+FILE_CACHE_SIZE = 128
+
+# Files at least this large are memory-mapped rather than read into memory
+MMAP_THRESHOLD = 64 * 1024
+
+# Bytes of a memory-mapped file lowercased at a time when searching
+SEARCH_WINDOW_SIZE = 1 << 20
+
+
+# A TOOL: line, optionally followed (after any other lines) by an ARGS: block
+# that runs, possibly over several lines, until the next TOOL: line or the end
+# of the response. A TOOL: line that is superseded by another TOOL: line before
+# any ARGS: line is skipped, so the call the ARGS belong to is the one matched.
+# ARGS are captured raw; _tool_call_args decides what whitespace to trim.
+_TOOL_CALL_RE = re.compile(
+    r"^[ \t]*TOOL:[ \t]*(?P<tool>[^\n]*?)[ \t]*$"
+    r"(?!(?:\n(?![ \t]*ARGS:)[^\n]*)*\n[ \t]*TOOL:)"
+    r"(?:(?:\n(?![ \t]*(?:TOOL|ARGS):)[^\n]*)*\n[ \t]*ARGS:[ \t]*(?P<args>.*?)"
+    r"(?=^[ \t]*TOOL:|\Z))?",
+    re.MULTILINE | re.DOTALL,
+)
+
+# Tools whose ARGS ('filename|content') may continue over several lines
+MULTILINE_ARG_TOOLS = frozenset({"write_file", "append_file"})
+
+
+def _tool_call_args(match: "re.Match[str]") -> str:
+    """
+    Extract the arguments of a _TOOL_CALL_RE match.
+    
+    Single-line arguments are stripped. Multi-line ones ('filename|content')
+    are file content, so only the ARGS line itself is stripped, plus any
+    whitespace just before a following TOOL: line; trailing newlines at the
+    end of the response are kept, and whitespace-only continuation lines
+    are dropped.
+    """
+    args = match.group("args")
+    if args is None:
+        return ""
+    if match.group("tool") not in MULTILINE_ARG_TOOLS:
+        return args.strip()
+    first, sep, rest = args.partition("\n")
+    if match.end() < match.endpos:
+        rest = rest.rstrip()
+    return first.rstrip() + sep + rest if rest.strip() else first.rstrip()
+
+
+def _parse_tool_call(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Find the first tool call in a model response.
+    
+    Returns:
+        (tool name, arguments), or None if the response has no TOOL: line
+    """
+    match = _TOOL_CALL_RE.search(text)
+    if not match:
+        return None
+    return match.group("tool"), _tool_call_args(match)
+
+
+def _tool_call_end(text: str) -> Optional[int]:
+    """
+    Find where the first complete TOOL/ARGS block ends in partial model output.
+    
+    Single-line tool calls end with the ARGS line; multi-line ones end where
+    the next TOOL: line starts. Only newline-terminated lines are considered.
+    
+    Returns:
+        Offset to cut the text at, or None if no complete tool call yet
+    """
+    complete = text.rfind("\n")
+    if complete == -1:
+        return None
+    # endpos hides the unfinished last line from the pattern, including from \Z
+    match = _TOOL_CALL_RE.search(text, 0, complete)
+    if not match or match.group("args") is None:
+        return None
+    if match.group("tool") not in MULTILINE_ARG_TOOLS:
+        return text.find("\n", match.start("args"))
+    # Multi-line ARGS only stop before another TOOL: line, not at the end of the
+    # text. Cut after their last non-whitespace character, before that TOOL:
+    # line, so parsing the cut text yields the same arguments as the full text.
+    if match.end() < complete:
+        return match.start("args") + len(match.group("args").rstrip())
+    return None
+
+
+def _decode_text(data: bytes, final: bool = True) -> str:
+    """
+    Decode UTF-8 file bytes the way a text-mode read would, normalizing newlines.
+    
+    Args:
+        data: Raw bytes, either a whole file or a prefix of it
+        final: False if data is a prefix; a multi-byte character cut off at
+            the end is then dropped instead of raising
+    """
+    text = codecs.getincrementaldecoder('utf-8')().decode(data, final)
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+@functools.lru_cache(maxsize=FILE_CACHE_SIZE)
+def _read_text_prefix(path: str, mtime_ns: int, size: int) -> str:
+    """
+    Read and decode just enough of a file to cover READ_FILE_MAX_CHARS.
+    
+    Cached on (path, mtime_ns, size), so a file that changes is read again.
+    """
+    # Read one character more than the limit (UTF-8 uses up to 4 bytes each)
+    with open(path, 'rb') as f:
+        head = f.read((READ_FILE_MAX_CHARS + 1) * 4)
+        at_eof = len(head) >= os.fstat(f.fileno()).st_size
+    return _decode_text(head, final=at_eof)
+
+
+@functools.lru_cache(maxsize=FILE_CACHE_SIZE)
+def _count_lines(path: str, mtime_ns: int, size: int) -> Optional[int]:
+    """
+    Count the lines in a file, or return None if it looks binary.
+    
+    Cached on (path, mtime_ns, size), so a file that changes is recounted.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        last = f.read(BINARY_PEEK_SIZE)
+        if _is_binary(last):
+            return None
+        # Count newlines on raw chunks rather than decoding every line
+        lines = last.count(b"\n")
+        while chunk := f.read(LINE_COUNT_CHUNK_SIZE):
+            lines += chunk.count(b"\n")
+            last = chunk
+    # A final line without a trailing newline still counts
+    if last and not last.endswith(b"\n"):
+        lines += 1
+    return lines
+
+
+def _clear_file_caches() -> None:
+    """Drop cached file reads after the assistant modifies the workspace."""
+    _read_text_prefix.cache_clear()
+    _count_lines.cache_clear()
+
+
+# os.open flags for write_file/append_file (O_BINARY only exists on Windows)
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+_APPEND_FLAGS = os.O_WRONLY | os.O_APPEND | getattr(os, "O_BINARY", 0)
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """Write all of data to a file descriptor, retrying on short writes."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _is_binary(head: bytes) -> bool:
+    """Treat a file as binary if its leading block contains a NUL byte."""
+    return b"\0" in head
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_search_term(search_term: str) -> "re.Pattern[bytes]":
+    """
+    Compile a search term into a literal, case-insensitive byte pattern.
+    
+    re.IGNORECASE only folds ASCII on byte patterns, so non-ASCII characters
+    are expanded into an alternation of their case variants.
+    """
+    parts = []
+    for ch in search_term:
+        variants = dict.fromkeys((ch, ch.lower(), ch.upper()))
+        escaped = [re.escape(v.encode('utf-8')) for v in variants]
+        if ch.isascii() or len(escaped) == 1:
+            parts.append(escaped[0])
+        else:
+            parts.append(b"(?:" + b"|".join(escaped) + b")")
+    return re.compile(b"".join(parts), re.IGNORECASE)
+
 
 class GemmaFileAssistant:
     """A file management assistant powered by Gemma 3 270M."""
     
+    # Cached location of ripgrep; search falls back to pure Python without it
+    _rg_path = shutil.which("rg")
+    
     def __init__(self, model: str = "gemma3:270m", workspace: str = "./workspace"):
         """
         Initialize the file assistant.
@@ -26,9 +247,16 @@ class GemmaFileAssistant:
         self.base_url = "http://localhost:11434"
         self.workspace = Path(workspace)
         
+        # Per-thread HTTP sessions (see _session)
+        self._local = threading.local()
+        
         # Create workspace if it doesn't exist
         self.workspace.mkdir(exist_ok=True)
         
+        # Resolve the workspace once; _safe_path checks containment by prefix
+        self._workspace_resolved = self.workspace.resolve()
+        self._workspace_resolved_str = str(self._workspace_resolved) + os.sep
+        
         # Define available tools
         self.tools = {
             "read_file": self.read_file,
@@ -39,6 +267,38 @@ class GemmaFileAssistant:
             "file_info": self.file_info,
             "search_in_files": self.search_in_files
         }
+        
+        # The system prompt only varies by the user request, so it is built once
+        self._system_prompt_prefix = self._build_system_prompt_prefix()
+        
+        # Pre-serialize the static parts of /api/generate request bodies. The
+        # query body stops inside the prompt string, right after the encoded
+        # system prompt prefix, so only the user's text is encoded per call
+        self._query_body_prefix = (
+            f'{{"model": {json.dumps(self.model)}, "stream": true, '
+            f'"options": {json.dumps(QUERY_OPTIONS)}, '
+            f'"prompt": {json.dumps(self._system_prompt_prefix)[:-1]}'
+        )
+        self._followup_body_prefix = (
+            f'{{"model": {json.dumps(self.model)}, "stream": false, '
+            f'"options": {json.dumps(FOLLOWUP_OPTIONS)}, "prompt": '
+        )
+    
+    @property
+    def _session(self) -> requests.Session:
+        """
+        The calling thread's keep-alive session to Ollama.
+        
+        requests does not guarantee Session is thread-safe, so each thread
+        (e.g. each aquery worker) gets its own session and connection.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.headers["Content-Type"] = "application/json"
+            self._local.session = session
+        return session
     
     def _safe_path(self, filename: str) -> Optional[Path]:
         """
@@ -50,15 +310,27 @@ class GemmaFileAssistant:
         Returns:
             Safe path or None if invalid
         """
+        path = self._safe_path_str(filename)
+        return Path(path) if path else None
+    
+    def _safe_path_str(self, filename: str) -> Optional[str]:
+        """
+        String-based _safe_path used by the tools, avoiding Path objects.
+        
+        Args:
+            filename: The filename to validate
+            
+        Returns:
+            Safe absolute path or None if invalid
+        """
         try:
-            # Resolve the path and ensure it's within workspace
-            file_path = (self.workspace / filename).resolve()
-            if self.workspace.resolve() not in file_path.parents and file_path != self.workspace.resolve():
-                if not file_path.is_relative_to(self.workspace.resolve()):
-                    return None
-            return file_path
+            # Resolve symlinks too, so links inside the workspace cannot escape it
+            path = os.path.realpath(os.path.join(self._workspace_resolved_str, filename))
         except Exception:
             return None
+        if path == self._workspace_resolved_str[:-1] or path.startswith(self._workspace_resolved_str):
+            return path
+        return None
     
     def read_file(self, filename: str) -> str:
         """Read the contents of a text file.
@@ -66,20 +338,23 @@ class GemmaFileAssistant:
         Args:
             filename: Name of the file to read (e.g., 'notes.txt', 'data/info.txt')
         """
-        file_path = self._safe_path(filename)
+        file_path = self._safe_path_str(filename)
         if not file_path:
             return f"Error: Invalid file path '{filename}'"
         
         try:
-            if not file_path.exists():
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
                 return f"Error: File '{filename}' does not exist"
             
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                # Limit size for model context
-                if len(content) > 2000:
-                    return f"File content (truncated to 2000 chars):\n{content[:2000]}..."
-                return f"File content:\n{content}"
+            content = _read_text_prefix(file_path, stat.st_mtime_ns, stat.st_size)
+            
+            # Limit size for model context
+            if len(content) > READ_FILE_MAX_CHARS:
+                return (f"File content (truncated to {READ_FILE_MAX_CHARS} chars):\n"
+                        f"{content[:READ_FILE_MAX_CHARS]}...")
+            return f"File content:\n{content}"
         except Exception as e:
             return f"Error reading file: {str(e)}"
     
@@ -99,16 +374,23 @@ class GemmaFileAssistant:
                 return "Error: Use format 'filename|content'"
             
             filename, content = parts
-            file_path = self._safe_path(filename.strip())
+            file_path = self._safe_path_str(filename.strip())
             
             if not file_path:
                 return f"Error: Invalid file path '{filename}'"
             
-            # Create parent directories if needed
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+            # Open directly and only create parent directories if that fails,
+            # so the common case costs no extra stat calls
+            try:
+                fd = os.open(file_path, _WRITE_FLAGS, 0o666)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                fd = os.open(file_path, _WRITE_FLAGS, 0o666)
+            try:
+                _write_all(fd, content.encode('utf-8'))
+            finally:
+                os.close(fd)
+            _clear_file_caches()
             
             return f"Successfully wrote {len(content)} characters to '{filename}'"
         except Exception as e:
@@ -130,17 +412,21 @@ class GemmaFileAssistant:
                 return "Error: Use format 'filename|content'"
             
             filename, content = parts
-            file_path = self._safe_path(filename.strip())
+            file_path = self._safe_path_str(filename.strip())
             
             if not file_path:
                 return f"Error: Invalid file path '{filename}'"
             
-            # Create file if it doesn't exist
-            if not file_path.exists():
+            try:
+                fd = os.open(file_path, _APPEND_FLAGS)
+            except FileNotFoundError:
+                # Create file if it doesn't exist
                 return self.write_file(args)
-            
-            with open(file_path, 'a', encoding='utf-8') as f:
-                f.write(content)
+            try:
+                _write_all(fd, content.encode('utf-8'))
+            finally:
+                os.close(fd)
+            _clear_file_caches()
             
             return f"Successfully appended {len(content)} characters to '{filename}'"
         except Exception as e:
@@ -161,12 +447,20 @@ class GemmaFileAssistant:
         try:
             files = []
             
-            # Use glob pattern matching
-            for file_path in self.workspace.glob(pattern):
-                if file_path.is_file():
-                    rel_path = file_path.relative_to(self.workspace)
-                    size = file_path.stat().st_size
-                    files.append(f"- {rel_path} ({size} bytes)")
+            if "/" in pattern or os.sep in pattern:
+                # Patterns reaching into subdirectories keep pathlib's glob semantics
+                for file_path in self.workspace.glob(pattern):
+                    if file_path.is_file():
+                        rel_path = file_path.relative_to(self.workspace)
+                        size = file_path.stat().st_size
+                        files.append(f"- {rel_path} ({size} bytes)")
+            else:
+                # Top-level patterns match names straight off scandir, whose
+                # entries carry the file type from the directory read
+                with os.scandir(self.workspace) as entries:
+                    for entry in entries:
+                        if fnmatch.fnmatch(entry.name, pattern) and entry.is_file():
+                            files.append(f"- {entry.name} ({entry.stat().st_size} bytes)")
             
             if not files:
                 return f"No files found matching pattern '{pattern}'"
@@ -181,15 +475,16 @@ class GemmaFileAssistant:
         Args:
             filename: Name of the file to delete (e.g., 'old_notes.txt', 'temp/data.txt')
         """
-        file_path = self._safe_path(filename)
+        file_path = self._safe_path_str(filename)
         if not file_path:
             return f"Error: Invalid file path '{filename}'"
         
         try:
-            if not file_path.exists():
+            if not os.path.exists(file_path):
                 return f"Error: File '{filename}' does not exist"
             
-            file_path.unlink()
+            os.unlink(file_path)
+            _clear_file_caches()
             return f"Successfully deleted '{filename}'"
         except Exception as e:
             return f"Error deleting file: {str(e)}"
@@ -200,15 +495,16 @@ class GemmaFileAssistant:
         Args:
             filename: Name of the file to inspect (e.g., 'document.txt', 'data/log.txt')
         """
-        file_path = self._safe_path(filename)
+        file_path = self._safe_path_str(filename)
         if not file_path:
             return f"Error: Invalid file path '{filename}'"
         
         try:
-            if not file_path.exists():
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
                 return f"Error: File '{filename}' does not exist"
             
-            stat = file_path.stat()
             info = [
                 f"File: {filename}",
                 f"Size: {stat.st_size} bytes",
@@ -218,10 +514,10 @@ class GemmaFileAssistant:
             
             # Add line count for text files
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = sum(1 for _ in f)
-                info.append(f"Lines: {lines}")
-            except:
+                lines = _count_lines(file_path, stat.st_mtime_ns, stat.st_size)
+                if lines is not None:
+                    info.append(f"Lines: {lines}")
+            except OSError:
                 pass
             
             return "\n".join(info)
@@ -235,43 +531,191 @@ class GemmaFileAssistant:
             search_term: Text to search for (case-insensitive, e.g., 'shopping', 'TODO', 'important')
         """
         try:
-            results = []
-            
-            for file_path in self.workspace.glob("**/*.txt"):
-                if file_path.is_file():
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            lines = f.readlines()
-                            for i, line in enumerate(lines, 1):
-                                if search_term.lower() in line.lower():
-                                    rel_path = file_path.relative_to(self.workspace)
-                                    results.append(f"{rel_path}:{i}: {line.strip()[:80]}")
-                    except:
-                        continue
+            if self._rg_path:
+                results = self._search_with_rg(search_term)
+            else:
+                results = self._search_with_python(search_term)
             
             if not results:
                 return f"No matches found for '{search_term}'"
             
             # Limit results
-            if len(results) > 20:
-                results = results[:20]
-                results.append(f"... and {len(results) - 20} more matches")
+            if len(results) > MAX_SEARCH_RESULTS:
+                results = results[:MAX_SEARCH_RESULTS]
+                results.append("... and more matches (results limited to "
+                               f"{MAX_SEARCH_RESULTS})")
             
             return f"Search results for '{search_term}':\n" + "\n".join(results)
         except Exception as e:
             return f"Error searching files: {str(e)}"
     
-    def query(self, prompt: str, verbose: bool = False) -> str:
+    def _search_with_rg(self, search_term: str) -> List[str]:
+        """Search .txt files with ripgrep (literal, case-insensitive)."""
+        proc = subprocess.run(
+            [
+                self._rg_path, "-F", "-i", "-n",
+                "--no-heading", "--with-filename", "--null",
+                "--hidden", "--no-ignore",
+                f"--max-count={MAX_SEARCH_RESULTS}", "--glob=*.txt",
+                "--", search_term, ".",
+            ],
+            cwd=self.workspace,
+            capture_output=True,
+            timeout=RG_TIMEOUT,
+        )
+        # Exit code 1 means no matches; 2 means an error, possibly with partial output
+        if proc.returncode == 2 and not proc.stdout:
+            raise RuntimeError(proc.stderr.decode("utf-8", errors="replace").strip())
+        
+        matches = []
+        # rg ends records only at '\n'; str.splitlines() would also split on
+        # form feeds, lone CRs, U+2028 and the like inside a matched line
+        for record in proc.stdout.split(b"\n"):
+            if not record:
+                continue
+            # With --null, rg emits 'path\0line:text'
+            rel_path, sep, rest = record.decode("utf-8", errors="replace").partition("\0")
+            if not sep:
+                continue
+            lineno, _, line = rest.partition(":")
+            if rel_path.startswith("./"):
+                rel_path = rel_path[2:]
+            if not lineno.isdigit():
+                continue
+            matches.append((rel_path, int(lineno), line))
+        
+        # rg walks directories in parallel, so its output order varies between
+        # runs; sort by path and line so the results that survive the
+        # MAX_SEARCH_RESULTS cut are stable and match the Python fallback
+        matches.sort(key=lambda m: (m[0], m[1]))
+        return [f"{rel_path}:{lineno}: {line.strip()[:80]}" for rel_path, lineno, line in matches]
+    
+    def _search_with_python(self, search_term: str) -> List[str]:
+        """Search .txt files in-process (used when ripgrep is unavailable)."""
+        # One extra result is enough to tell the model the list was cut short
+        limit = MAX_SEARCH_RESULTS + 1
+        # Scan in relative-path order, the same order the ripgrep path sorts into
+        paths = sorted(self._iter_text_files(), key=lambda p: p[1])
+        results = []
+        
+        # File reads and bytes scans release the GIL, so files are scanned in
+        # parallel; each worker returns its own list and results are merged
+        # in path order to keep output deterministic
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [
+                executor.submit(self._scan_file, path, rel_path, search_term, limit)
+                for path, rel_path in paths
+            ]
+            for future in futures:
+                try:
+                    results.extend(future.result())
+                except (OSError, ValueError):
+                    # Unreadable file, or one emptied before it could be mapped
+                    continue
+                if len(results) >= limit:
+                    executor.shutdown(cancel_futures=True)
+                    break
+        return results[:limit]
+    
+    def _iter_text_files(self) -> Iterator[Tuple[str, str]]:
+        """Walk the workspace with os.scandir, yielding (path, relative path) for .txt files."""
+        stack = [(str(self.workspace), "")]
+        while stack:
+            dir_path, rel_dir = stack.pop()
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        rel_path = rel_dir + entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel_path + os.sep))
+                        elif entry.name.endswith(".txt") and entry.is_file():
+                            yield entry.path, rel_path
+            except OSError:
+                continue
+    
+    def _scan_file(self, file_path: str, rel_path: str, search_term: str, limit: int) -> List[str]:
+        """Scan a whole file for a term, one result per matching line."""
+        with open(file_path, 'rb') as f:
+            head = f.read(BINARY_PEEK_SIZE)
+            if _is_binary(head):
+                return []
+            if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+                # Large files are scanned in place without copying them into memory
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return self._scan_buffer(mm, rel_path, search_term, limit)
+            buf = head + f.read()
+        return self._scan_buffer(buf, rel_path, search_term, limit)
+    
+    def _scan_buffer(self, buf, rel_path: str, search_term: str, limit: int) -> List[str]:
         """
-        Process a user query, potentially using tools.
+        Find matching lines in a bytes or mmap buffer.
         
         Args:
-            prompt: The user's question or request
-            verbose: Whether to print debug information
-            
-        Returns:
-            The assistant's response
+            buf: File contents as bytes or a read-only mmap
+            rel_path: Path reported in results, relative to the workspace
+            search_term: Text to search for (case-insensitive)
+            limit: Maximum number of results to return
         """
+        mapped = isinstance(buf, mmap.mmap)
+        
+        if search_term.isascii() and not mapped:
+            # bytes.lower() folds ASCII only, which is exact for an ASCII needle,
+            # and keeps offsets identical to the original buffer
+            haystack = buf.lower()
+            needle = search_term.encode('ascii').lower()
+            
+            def find(pos: int) -> Optional[Tuple[int, int]]:
+                start = haystack.find(needle, pos)
+                return None if start == -1 else (start, start + len(needle))
+        elif search_term.isascii():
+            # Lowercasing a whole mapping would copy it, so lowercase bounded
+            # windows (overlapping by len(needle) - 1) and keep the literal find,
+            # which is several times faster than an IGNORECASE regex
+            needle = search_term.encode('ascii').lower()
+            overlap = max(len(needle) - 1, 0)
+            
+            def find(pos: int) -> Optional[Tuple[int, int]]:
+                while pos < len(buf):
+                    window = buf[pos:pos + SEARCH_WINDOW_SIZE + overlap].lower()
+                    start = window.find(needle)
+                    if start != -1:
+                        return pos + start, pos + start + len(needle)
+                    pos += SEARCH_WINDOW_SIZE
+                return None
+        else:
+            # Non-ASCII terms need the case-variant pattern
+            pattern = _compile_search_term(search_term)
+            
+            def find(pos: int) -> Optional[Tuple[int, int]]:
+                match = pattern.search(buf, pos)
+                return match.span() if match else None
+        
+        results = []
+        lineno = 1
+        counted = 0
+        pos = 0
+        while pos < len(buf) and len(results) < limit:
+            span = find(pos)
+            if span is None:
+                break
+            start = buf.rfind(b"\n", 0, span[0]) + 1
+            end = buf.find(b"\n", span[1])
+            if end == -1:
+                end = len(buf)
+            # Count newlines incrementally instead of splitting into lines;
+            # mmap has no count(), so count over a slice of it instead
+            if mapped:
+                lineno += buf[counted:start].count(b"\n")
+            else:
+                lineno += buf.count(b"\n", counted, start)
+            counted = start
+            line = buf[start:end].decode('utf-8', errors='replace')
+            results.append(f"{rel_path}:{lineno}: {line.strip()[:80]}")
+            pos = end + 1
+        return results
+    
+    def _build_system_prompt_prefix(self) -> str:
+        """Build the static part of the system prompt (everything before the user request)."""
         # Create tool descriptions
         tool_descriptions = []
         for name, func in self.tools.items():
@@ -281,7 +725,7 @@ class GemmaFileAssistant:
         tools_text = "\n".join(tool_descriptions)
         
         # Build the full prompt with stronger tool-calling guidance
-        system_prompt = f"""You are a file assistant. When users ask you to work with files, you MUST use tools.
+        return f"""You are a file assistant. When users ask you to work with files, you MUST use tools.
 
 WORKSPACE: {self.workspace.absolute()}
 
@@ -333,57 +777,45 @@ CRITICAL FORMAT RULES:
 - Everything after | is the file content
 - Use actual filenames like 'shopping.txt', 'notes.txt', 'list.txt'
 
-User request: {prompt}"""
+User request: """
+    
+    def query(self, prompt: str, verbose: bool = False) -> str:
+        """
+        Process a user query, potentially using tools.
         
+        Args:
+            prompt: The user's question or request
+            verbose: Whether to print debug information
+            
+        Returns:
+            The assistant's response
+        """
         if verbose:
             print(f"[DEBUG] Sending prompt to model...")
         
-        # Query the model
+        # Query the model, streaming so generation can be cut short once a
+        # complete tool call has been emitted
         try:
-            response = requests.post(
+            with self._session.post(
                 f"{self.base_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": system_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.1,
-                        "top_k": 10,
-                        "top_p": 0.8,
-                        "num_predict": 512
-                    }
-                },
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()['response']
-        except requests.exceptions.RequestException as e:
+                data=self._encode_query_body(prompt),
+                timeout=30,
+                stream=True
+            ) as response:
+                response.raise_for_status()
+                result = self._read_streamed_response(response)
+        except (requests.exceptions.RequestException, ValueError) as e:
             return f"Error communicating with Ollama: {str(e)}. Is Ollama running?"
         
         if verbose:
             print(f"[DEBUG] Model response: {result[:200]}...")
         
         # Check if the model wants to use a tool
-        if "TOOL:" in result:
+        tool_call = _parse_tool_call(result)
+        if tool_call:
             if verbose:
                 print(f"[DEBUG] Tool call detected in response")
-            lines = result.split('\n')
-            tool_name = None
-            args = ""
-            
-            for i, line in enumerate(lines):
-                if line.strip().startswith("TOOL:"):
-                    tool_name = line.replace("TOOL:", "").strip()
-                elif line.strip().startswith("ARGS:"):
-                    # Get everything after ARGS:
-                    args = line.replace("ARGS:", "").strip()
-                    # Also check if args continue on next lines
-                    if i + 1 < len(lines) and not lines[i + 1].strip().startswith("TOOL:"):
-                        # Might be multi-line content
-                        remaining = "\n".join(lines[i + 1:])
-                        if remaining.strip():
-                            args = args + "\n" + remaining
-                            break
+            tool_name, args = tool_call
             
             if verbose:
                 print(f"[DEBUG] Tool: {tool_name}, Args: {args[:100]}...")
@@ -404,17 +836,9 @@ User request: {prompt}"""
 Based on this result, please provide a helpful response to the user's original request: {prompt}"""
                 
                 try:
-                    response = requests.post(
+                    response = self._session.post(
                         f"{self.base_url}/api/generate",
-                        json={
-                            "model": self.model,
-                            "prompt": followup,
-                            "stream": False,
-                            "options": {
-                                "temperature": 0.3,
-                                "num_predict": 256
-                            }
-                        },
+                        data=(self._followup_body_prefix + json.dumps(followup) + "}").encode('ascii'),
                         timeout=30
                     )
                     response.raise_for_status()
@@ -427,6 +851,63 @@ Based on this result, please provide a helpful response to the user's original r
                     return f"Unknown tool: {tool_name}. Available tools: {', '.join(self.tools.keys())}"
         
         return result
+    
+    def _encode_query_body(self, prompt: str) -> bytes:
+        """
+        Build the JSON body for the initial /api/generate call.
+        
+        JSON escapes each character independently, so the encoded user prompt
+        (minus its opening quote) can be appended to the pre-encoded prefix.
+        """
+        return (self._query_body_prefix + json.dumps(prompt)[1:] + "}").encode('ascii')
+    
+    def _read_streamed_response(self, response: requests.Response) -> str:
+        """
+        Accumulate a streamed /api/generate response.
+        
+        Stops reading as soon as a complete TOOL/ARGS block is available;
+        closing the response then disconnects and Ollama stops generating.
+        
+        Args:
+            response: Streaming response from /api/generate
+            
+        Returns:
+            The generated text, trimmed to the first tool call if one was found
+        """
+        parts = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            text = chunk.get("response", "")
+            parts.append(text)
+            if chunk.get("done"):
+                break
+            # A tool call can only become complete when a line ends
+            if "\n" in text:
+                result = "".join(parts)
+                end = _tool_call_end(result)
+                if end is not None:
+                    return result[:end]
+        return "".join(parts)
+    
+    async def aquery(self, prompt: str, verbose: bool = False) -> str:
+        """
+        Async variant of query for use from an event loop.
+        
+        The blocking HTTP calls and file tools run in a worker thread, so
+        the event loop is not stalled. Concurrent calls each use their own
+        thread's session; their verbose output may interleave, and tools
+        writing the same file are not serialized against each other.
+        
+        Args:
+            prompt: The user's question or request
+            verbose: Whether to print debug information
+            
+        Returns:
+            The assistant's response
+        """
+        return await asyncio.to_thread(self.query, prompt, verbose)
 
 
 def main():